@@ -63,6 +63,9 @@
 # from itertools import islice # there was a reason for this.
 import sqlite3 as lite
 import logging
+import heapq
+import math
+import re
 
 
 ####################################################
@@ -97,6 +100,47 @@ _TAGS_XREF_SQL = \
             FOREIGN KEY(pageid) REFERENCES page(id) ON DELETE CASCADE)
      '''
 
+# one row per key, holding the seq of the last time it changed. (deleted
+# keys are kept as 'tombstones', so replicas know to delete them too.)
+# This one is IF NOT EXISTS, as it survives a purge(everything=True).
+_CHANGES_TABLE_SQL = \
+    u'''CREATE TABLE IF NOT EXISTS 'pagechange'
+           (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE ON CONFLICT REPLACE NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0)
+     '''
+
+# the precomputed top-k related pages for each page (see build_related),
+# and the settings it was last built with (so it can be kept up to date):
+# These are IF NOT EXISTS, as build_related creates them on older dbs.
+_RELATED_TABLE_SQL = \
+    u'''CREATE TABLE IF NOT EXISTS 'related'
+           (pageid INTEGER NOT NULL,
+            relatedid INTEGER NOT NULL,
+            score REAL NOT NULL,
+            FOREIGN KEY(pageid) REFERENCES page(id) ON DELETE CASCADE,
+            FOREIGN KEY(relatedid) REFERENCES page(id) ON DELETE CASCADE)
+     '''
+
+_RELATED_INDEX_SQL = \
+    u'''CREATE INDEX IF NOT EXISTS 'related_pageid' ON related(pageid)'''
+
+_RELATED_REVERSE_INDEX_SQL = \
+    u'''CREATE INDEX IF NOT EXISTS 'related_relatedid'
+           ON related(relatedid)'''
+
+_RELATED_CONF_SQL = \
+    u'''CREATE TABLE IF NOT EXISTS 'relatedconf'
+           (k INTEGER NOT NULL,
+            weighting TEXT NOT NULL,
+            fulltext REAL NOT NULL,
+            stale INTEGER NOT NULL DEFAULT 0)
+     '''
+
+# valid related weightings (for asserts)
+
+_WEIGHTINGS = (u'idf', u'count')
+
 # valid column names (for asserts)
 
 _VALID_COLUMNS = (u'id', u'key', u'html', u'json')
@@ -117,6 +161,91 @@ def _qs(items):
     ''' returns a list of '?' for each item in $items, for use in queries. '''
     return u','.join((u'?' for _ in items)) # ?, ?, ...
 
+def _tuple(items):
+    ''' allow $items to be a string, or any iterable, and return a tuple. '''
+    # I know, I know, isinstance considered harmful. However,
+    # this is the simplist way to do it:
+    if isinstance(items, str) or isinstance(items, unicode):
+        return (items,)
+    elif type(items) is not tuple:
+        return tuple(items)
+    return items
+
+def _chunks(items, size=500):
+    ''' split $items up into lists of at most $size, so we don't go over
+        sqlite's limit on the number of '?'s in a query. '''
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _tags_where(tags, exclude, require):
+    ''' returns a (u'WHERE clause', values) pair, selecting pages which
+        have any of $tags, all of $require, and none of $exclude. '''
+    # I feel sure there should be a way to do this with JOINs, which
+    # might be quicker...
+    clauses = []
+    values = ()
+
+    if tags or not require:
+        clauses.append(
+            u" page.id IN " \
+            u"           ( SELECT pageid from tag, tagxref " \
+            u"              WHERE tag.name IN ( {0} )" \
+            u"                AND tagxref.tagid == tag.id) ".format(_qs(tags)))
+        values += tags
+
+    if require:
+        clauses.append(
+            u" page.id IN " \
+            u"           ( SELECT pageid from tag, tagxref " \
+            u"              WHERE tag.name IN ( {0} )" \
+            u"                AND tagxref.tagid == tag.id" \
+            u"              GROUP BY pageid" \
+            u"              HAVING COUNT(DISTINCT tagxref.tagid) == ?) "
+            .format(_qs(require)))
+        values += require + (len(set(require)),)
+
+    clauses.append(
+            u" page.id NOT IN " \
+            u"           ( SELECT pageid from tag, tagxref " \
+            u"              WHERE tag.name IN ( {0} ) " \
+            u"                AND tagxref.tagid == tag.id)".format(
+            _qs(exclude)))
+    values += exclude
+
+    return u' AND '.join(clauses), values
+
+def _weight(weighting, pages, df):
+    ''' how much sharing a tag (or word) which $df of the $pages have is
+        worth, for related pages. '''
+    if weighting == u'idf':
+        return math.log(float(pages) / df)
+    return 1.0
+
+def _terms(text):
+    ''' the set of words in $text, split up the same way as the fts 'simple'
+        tokenizer does it: any ascii which isn't a letter or number splits
+        words (so '_' does), everything else (non-ascii) is part of a word,
+        and only ascii gets lowercased. '''
+    text = re.sub(u'[A-Z]+', lambda m: m.group(0).lower(), text or u'')
+    return set(t for t in
+               re.split(u'[\x00-\x2f\x3a-\x40\x5b-\x60\x7b-\x7f]+', text)
+               if t)
+
+def _related_scores(pageid, features):
+    ''' {pageid: score} of everything related to $pageid.  $features is a
+        list of (weight, set(pageids)) for each tag/word $pageid has. '''
+    scores = {}
+    for weight, pages in features:
+        for other in pages:
+            if other != pageid:
+                scores[other] = scores.get(other, 0.0) + weight
+    return scores
+
+def _top(scores, k):
+    ''' the best $k (pageid, score) pairs from $scores.
+        (ties go to the older page.) '''
+    return heapq.nlargest(k, ((p, s) for p, s in scores.items() if s > 0),
+                          key=lambda x: (x[1], -x[0]))
+
 #####################################################
 #
 # PageStore:
@@ -145,7 +274,24 @@ class PageStore(object):
 
     changed = False
 
-    def __init__(self, db_filename=':memory:', synchronous='OFF'):
+    # has the pagechange table been checked for? (see _log_change)
+    _changes_table = False
+
+    # build_related's settings, once they've been looked up, or None if it's
+    # not been run. (see _related_conf)
+    _related_settings = False
+
+    # the in-memory tag index, when tag_index is on. (see _tag_index)
+    _tags = None
+
+    def __init__(self, db_filename=':memory:', synchronous='OFF',
+                 tag_index=False):
+        ''' if tag_index is True, then the tag->pages links are all loaded
+            into memory (the first time they're needed), and get_by_tags &
+            count_by_tags work them out from there, rather than with
+            subqueries.  Kept up to date by store/update/purge - so don't
+            write to the db behind its back, or roll back. '''
+        self.tag_index = tag_index
 
         self.log = logging.getLogger(__name__)
         self.log.addHandler(logging.NullHandler())
@@ -178,6 +324,15 @@ class PageStore(object):
 
         self.cur.execute(_TAGS_XREF_SQL)
 
+        self.cur.execute(_CHANGES_TABLE_SQL)
+        self._changes_table = True
+
+        self._create_related_tables()
+
+        # new tables, so any old tag index / related settings are out of date:
+        self._tags = None
+        self._related_settings = False
+
     def __enter__(self):
         ''' called with the 'with' pattern. '''
         return self
@@ -252,6 +407,13 @@ class PageStore(object):
         else:
             return item
 
+    def _tags_of_pageid(self, pageid):
+        ''' list of tag names linked to page $pageid '''
+        return [x[0] for x in self.execute(
+                    u"SELECT tag.name FROM tag, tagxref"
+                    u" WHERE tagxref.tagid = tag.id"
+                    u"   AND tagxref.pageid = ?", pageid).fetchall()]
+
     def get_tags_of_page(self, key):
         return [x[0] for x in self.execute(
                     u"SELECT tag.name FROM tag, tagxref"
@@ -263,6 +425,9 @@ class PageStore(object):
     def get_by_tag(self, tag, columns=u'json'):
         ''' retrieve a list of pages by tag '''
 
+        if self.tag_index:
+            return self.get_by_tags((tag,), columns)
+
         query = _col_select(columns,
                 u" FROM page, tag, tagxref " \
                 u" WHERE tag.name == ?" \
@@ -271,37 +436,85 @@ class PageStore(object):
 
         return self._return_columns(columns, query, tag)
 
-    def get_by_tags(self, tags, columns=u'json', exclude=()):
+    def get_by_tags(self, tags, columns=u'json', exclude=(), require=()):
         ''' gets all pages which have *any* of the tags listed.
-            there is an exclude option too. '''
-        # I know, I know, isinstance considered harmful. However,
-        # this is the simplist way to do it:
-        # (allow tags or exclude to be strings, or lists/tuples)
-        if isinstance(tags, str) or isinstance(tags, unicode):
-            tags = (tags,)
-        elif type(tags) is not tuple:
-            tags = tuple(tags)
-
-        if isinstance(exclude, str) or isinstance(exclude, unicode):
-            exclude = (exclude,)
-        elif type(exclude) is not tuple:
-            exclude = tuple(exclude)
-
-        # I feel sure there should be a way to do this with JOINs, which
-        # might be quicker...
-        query = _col_select(columns,
-            u" FROM page " \
-            u" WHERE page.id IN " \
-            u"           ( SELECT pageid from tag, tagxref " \
-            u"              WHERE tag.name IN ( {0} )" \
-            u"                AND tagxref.tagid == tag.id) " \
-            u" AND page.id NOT IN " \
-            u"           ( SELECT pageid from tag, tagxref " \
-            u"              WHERE tag.name IN ( {1} ) " \
-            u"                AND tagxref.tagid == tag.id)".format(
-            _qs(tags), _qs(exclude)))
+            there is an exclude option too, and a require option, for tags
+            which pages must have *all* of. '''
+        tags, exclude, require = _tuple(tags), _tuple(exclude), _tuple(require)
+
+        if self.tag_index:
+            ids = self._indexed_pageids(tags, exclude, require)
+            # only hit the db for the columns we actually want:
+            return [row for chunk in _chunks(ids) for row in
+                    self._return_columns(columns, _col_select(columns,
+                        u" FROM page WHERE id IN ( {0} ) ORDER BY id".format(
+                        _qs(chunk))), *chunk)]
+
+        where, values = _tags_where(tags, exclude, require)
+
+        return self._return_columns(columns,
+            _col_select(columns, u" FROM page WHERE " + where), *values)
+
+    def count_by_tags(self, tags, exclude=(), require=()):
+        ''' how many pages would get_by_tags return? '''
+        tags, exclude, require = _tuple(tags), _tuple(exclude), _tuple(require)
+
+        if self.tag_index:
+            return len(self._indexed_pageids(tags, exclude, require))
+
+        where, values = _tags_where(tags, exclude, require)
+
+        return self.execute(u"SELECT COUNT(*) FROM page WHERE " + where,
+                            *values).fetchone()[0]
+
+    def _tag_index(self):
+        ''' the in-memory {tag: set(pageids)} index, loaded from the db
+            the first time it's needed. '''
+        if self._tags is None:
+            self.log.debug('Loading tag index')
+            self._tags = {}
+            for name, pageid in self.execute(
+                    u"SELECT tag.name, tagxref.pageid FROM tag, tagxref"
+                    u" WHERE tagxref.tagid == tag.id").fetchall():
+                self._tags.setdefault(name, set()).add(pageid)
+        return self._tags
+
+    def _indexed_pageids(self, tags, exclude, require):
+        ''' sorted list of page ids matching tags (any), require (all),
+            and not exclude (any), all from the in-memory index. '''
+        index = self._tag_index()
+        empty = frozenset()
+
+        if not tags and not require:
+            return []
+
+        if tags:
+            ids = set().union(*(index.get(t, empty) for t in tags))
+        else:
+            ids = set(index.get(require[0], empty))
+
+        for t in require:
+            ids &= index.get(t, empty)
+        for t in exclude:
+            ids -= index.get(t, empty)
 
-        return self._return_columns(columns, query, *(tags + exclude))
+        return sorted(ids)
+
+    def _index_link(self, pageid, tags):
+        ''' add $pageid to $tags in the in-memory index (if it's loaded) '''
+        if self._tags is not None:
+            for t in tags:
+                self._tags.setdefault(t, set()).add(pageid)
+
+    def _index_unlink(self, pageid, tags):
+        ''' remove $pageid from $tags in the in-memory index (if loaded) '''
+        if self._tags is not None:
+            for t in tags:
+                ids = self._tags.get(t)
+                if ids is not None:
+                    ids.discard(pageid)
+                    if not ids:
+                        del self._tags[t]
 
 
     def purge(self, page_key=False, everything=False):
@@ -309,14 +522,46 @@ class PageStore(object):
         self.changed = True
 
         if page_key:
+            pageid = self.execute(u"SELECT id FROM page WHERE key == ?",
+                                  page_key).fetchone()
+            stale = []
+            if pageid:
+                if self._tags is not None:
+                    self._index_unlink(pageid[0],
+                                       self._tags_of_pageid(pageid[0]))
+
+            conf = self._related_conf() if pageid else None
+            if conf and conf[1] == u'idf':
+                self._mark_related_stale()
+            elif conf:
+                # pages which had this one as related need working out again:
+                stale = [x[0] for x in self.execute(
+                    u"SELECT pageid FROM related WHERE relatedid = ?",
+                    pageid[0]).fetchall()]
+
+            # the fts table isn't a real table, so doesn't cascade:
+            self.execute(u"DELETE FROM pagefts WHERE docid IN"
+                         u" (SELECT id FROM page WHERE key == ?)", page_key)
             self.execute(u"DELETE FROM 'page' WHERE key == ?", page_key)
             # this AUTOMATICALLY (due to SQL coolness)
             # should delete tagxrefs too...
             # TODO: think about checking here for unused tags?
+            if self.cur.rowcount > 0:
+                self._log_change(page_key, deleted=True)
+                self._refresh_related(stale)
 
         if everything:
+            # leave tombstones for everything, so replicas get emptied too:
+            # (if there's anything there - this might never have been
+            #  initialised)
+            if self._has_table(u'page'):
+                self._ensure_changes_table()
+                self.execute(u"INSERT INTO pagechange(key, deleted)"
+                             u" SELECT key, 1 FROM page ORDER BY id")
             # possible slight performance hit - both here and in 'initialise'
             # we check IF EXISTS on all tables.  Should be negligable, though.
+            self.execute(u"DROP TABLE IF EXISTS related")
+            self.execute(u"DROP TABLE IF EXISTS relatedconf")
             self.execute(u"DROP TABLE IF EXISTS tagxref")
             self.execute(u"DROP TABLE IF EXISTS tag")
             self.execute(u"DROP TABLE IF EXISTS page")
@@ -340,6 +585,7 @@ class PageStore(object):
                      u'  SELECT rowid, ? FROM tag WHERE name IN (' \
                          + _qs(tags) + u')', # ?, ?, ...
                      page, *tags)
+        self._index_link(page, tags)
 
     def store(self, key, html, json, fulltext, tags):
         ''' store an page in the store, including setting up the searchable
@@ -363,6 +609,10 @@ class PageStore(object):
         # link page to tags:
         self._link_tags(rowid, tags)
 
+        self._related_changed(rowid)
+
+        self._log_change(key)
+
 
 #    def store_many(self, generator):
 #        ''' You give this function a generator (or list) which has in it tuples
@@ -379,31 +629,363 @@ class PageStore(object):
             If you want to update the key, use old_key to specify the
             previous key.
             If the key is not found, then a new page will be added. '''
+        self.update_many(((key, html, json, fulltext, tags, old_key),))
+
+    def update_many(self, pages):
+        ''' Update (or store, if they don't exist yet) lots of pages at once.
+            $pages is an iterable (list, generator, whatever) of tuples in the
+            format:
+            (key, html, json, fulltext, tags)
+            or, if you want to rename a page:
+            (key, html, json, fulltext, tags, old_key)
+
+            Everything is written in the one transaction (committed when the
+            'with' block closes, as usual).  Only what has actually changed
+            gets written: the page row, the fts index, and only the tags
+            which have been added or removed.  Pages which haven't changed
+            at all don't turn up in changes_since either. '''
         self.changed = True
 
-        # first get the appropriate id:
-        self.execute(u"SELECT id FROM page WHERE key = ?", \
-                     old_key if old_key else key)
-        docid = self.cur.fetchone()
-
-        # doesn't exist already, so write new entry.
-        if not docid:
-            return self.store(key, html, json, fulltext, tags)
-        else:
-            docid = docid[0]
-
-        # update the main table:
-        self.execute(u"UPDATE page SET key=?, html=?, json=? WHERE id=?",
-                     key, html, json, docid)
-
-        # update the fts table
-        self.execute(u"UPDATE pagefts SET fulltext=? WHERE docid=?",
-                     fulltext, docid)
+        for page in pages:
+            key, html, json, fulltext, tags = page[:5]
+            old_key = page[5] if len(page) > 5 else None
+
+            # first get the appropriate id, and what's there at the moment:
+            docid = self.execute(
+                u"SELECT id, key, html, json, (SELECT fulltext FROM pagefts"
+                u"                             WHERE docid = page.id)"
+                u" FROM page WHERE key = ?",
+                old_key if old_key else key).fetchone()
+
+            # doesn't exist already, so write new entry.
+            if not docid:
+                self.store(key, html, json, fulltext, tags)
+                continue
+            else:
+                docid, current_key, old_html, old_json, old_fulltext = docid
+
+            renamed = key != current_key
+            page_changed = renamed or html != old_html or json != old_json
+
+            # update the main table, but only if we need to:
+            if page_changed:
+                self.execute(u"UPDATE page SET key=?, html=?, json=?"
+                             u" WHERE id=?", key, html, json, docid)
+
+                # key is UNIQUE ON CONFLICT IGNORE, so renaming onto a key
+                # which is already used does nothing - so leave the rest
+                # alone too:
+                if self.cur.rowcount < 1:
+                    self.log.warning('Not renaming %s to %s: key already'
+                                     ' exists', current_key, key)
+                    continue
+
+            # update the fts table, but only if we need to:
+            if fulltext != old_fulltext:
+                self.execute(u"UPDATE pagefts SET fulltext=? WHERE docid=?",
+                             fulltext, docid)
+
+            # work out which tags have actually changed:
+            old_tags = set(self._tags_of_pageid(docid))
+            tags = set(tags)
+
+            added = tuple(tags - old_tags)
+            removed = tuple(old_tags - tags)
+
+            if added:
+                self.create_tags(added)
+                self._link_tags(docid, added)
+            # TODO: think about deleting unused tags
+
+            if removed:
+                self.execute(u'DELETE FROM tagxref WHERE pageid=?' \
+                             u'  AND tagid IN (SELECT id FROM tag' \
+                             u'                 WHERE name IN (' \
+                                 + _qs(removed) + u'))', # ?, ?, ...
+                             docid, *removed)
+                self._index_unlink(docid, removed)
+
+            if added or removed or fulltext != old_fulltext:
+                self._related_changed(docid,
+                                      tags_changed=bool(added or removed))
+
+            if page_changed or added or removed or fulltext != old_fulltext:
+                if renamed:
+                    self._log_change(current_key, deleted=True)
+                self._log_change(key)
+
+    def _has_table(self, name):
+        ''' does the table $name exist in this db? '''
+        return self.execute(u"SELECT 1 FROM sqlite_master"
+                            u" WHERE type = 'table' AND name = ?",
+                            name).fetchone() is not None
+
+    def _ensure_changes_table(self):
+        ''' create the pagechange table, if this db is from before it
+            existed. (only checked once.) '''
+        if not self._changes_table:
+            self.execute(_CHANGES_TABLE_SQL)
+            self._changes_table = True
+
+    def _log_change(self, key, deleted=False):
+        ''' bump $key to the top of the change feed. '''
+        self._ensure_changes_table()
+        self.execute(u"INSERT INTO pagechange(key, deleted) VALUES(?, ?)",
+                     key, 1 if deleted else 0)
+
+    def changes_since(self, seq=0):
+        ''' iterate over every page which has changed since $seq, in order,
+            as tuples of:
+            (seq, key, deleted, html, json, fulltext, tags)
+            deleted pages ('tombstones') have deleted=True, and None for
+            everything else.  Each key only turns up once, with its latest
+            state, so you can feed these to another PageStore's
+            apply_changes, and remember the last seq for next time.
+            (Don't write to this store while iterating.) '''
+
+        self._ensure_changes_table()
+
+        # a separate cursor, as self.cur gets used inside the loop:
+        changes = self.connection.cursor().execute(
+            u"SELECT pagechange.seq, pagechange.key, pagechange.deleted,"
+            u"       page.id, page.html, page.json"
+            u"  FROM pagechange LEFT JOIN page ON page.key = pagechange.key"
+            u" WHERE pagechange.seq > ? ORDER BY pagechange.seq", (int(seq),))
+
+        for seq, key, deleted, pageid, html, json in changes:
+            if deleted or pageid is None:
+                yield (seq, key, True, None, None, None, None)
+            else:
+                fulltext = self.execute(
+                    u"SELECT fulltext FROM pagefts WHERE docid = ?",
+                    pageid).fetchone()[0]
+                yield (seq, key, False, html, json, fulltext,
+                       self._tags_of_pageid(pageid))
+
+    def apply_changes(self, changes):
+        ''' apply a change feed (from another PageStore's changes_since) to
+            this store.  Returns the last seq applied (or None, if there were
+            no changes), to pass to changes_since next time. '''
+        self.changed = True
+        last_seq = None
+
+        for seq, key, deleted, html, json, fulltext, tags in changes:
+            if deleted:
+                self.purge(key)
+            else:
+                self.update(key, html, json, fulltext, tags)
+            last_seq = seq
+
+        return last_seq
+
+    def build_related(self, k=5, weighting=u'idf', fulltext=0.0):
+        ''' work out the top $k related pages of every page, from how many
+            tags they share, and store them for get_related.
+            weighting is either 'idf' (sharing rare tags counts for more) or
+            'count' (every shared tag counts the same).  If fulltext is set,
+            shared words in the fulltext count too, multiplied by it.
+
+            With 'count', store/update/purge keep it up to date from then on.
+            That does make writing slower though, as each change also works
+            out again every page the changed one is (or now could be) in the
+            top k of - which, with common tags, can be a lot of pages.  So
+            for big bulk loads, build this afterwards.
+
+            With 'idf', every change alters the weights of every page, so
+            changes just mark it as stale instead (see related_stale), and
+            you need to run rebuild_related() once you're done. '''
+        assert weighting in _WEIGHTINGS
+        self.changed = True
 
-        # update the tags table
-        self.create_tags(tags)
-        # TODO: think about deleting unused tags
+        self._create_related_tables()
+
+        pageids = [x[0] for x in self.execute(
+            u"SELECT id FROM page").fetchall()]
+
+        # load all of the tags & words, rather than asking page by page:
+        pages_with = {}
+        features_of = {}
+
+        for tagid, pageid in self.execute(
+                u"SELECT tagid, pageid FROM tagxref").fetchall():
+            pages_with.setdefault((u'tag', tagid), set()).add(pageid)
+            features_of.setdefault(pageid, []).append((u'tag', tagid))
+
+        if fulltext:
+            for docid, text in self.execute(
+                    u"SELECT docid, fulltext FROM pagefts").fetchall():
+                for term in _terms(text):
+                    pages_with.setdefault((u'term', term), set()).add(docid)
+                    features_of.setdefault(docid, []).append((u'term', term))
+
+        weights = {}
+        for feature, pages in pages_with.items():
+            weights[feature] = _weight(weighting, len(pageids), len(pages)) \
+                               * (fulltext if feature[0] == u'term' else 1.0)
+
+        self.execute(u"DELETE FROM related")
+        self.execute(u"DELETE FROM relatedconf")
+        self.execute(u"INSERT INTO relatedconf(k, weighting, fulltext, stale)"
+                     u" VALUES(?, ?, ?, 0)",
+                     int(k), weighting, float(fulltext))
+        self._related_settings = (int(k), weighting, float(fulltext), 0)
+
+        self.cur.executemany(
+            u"INSERT INTO related(pageid, relatedid, score) VALUES(?, ?, ?)",
+            ((pageid, other, score) for pageid in pageids
+             for other, score in _top(_related_scores(pageid,
+                 [(weights[f], pages_with[f])
+                  for f in features_of.get(pageid, ())]), k)))
+
+    def rebuild_related(self):
+        ''' run build_related again, with the same settings as last time
+            (if it's ever been run). '''
+        conf = self._related_conf()
+        if conf:
+            self.build_related(*conf[:3])
+
+    def related_stale(self):
+        ''' have pages changed since build_related, in a way which it couldn't
+            keep up with? (see build_related) '''
+        conf = self._related_conf()
+        return bool(conf and conf[3])
+
+    def get_related(self, key, columns=u'json'):
+        ''' get the related pages (as worked out by build_related) of the
+            page $key, most related first. '''
+        conf = self._related_conf()
+        if not conf:
+            return []
+        elif conf[3]:
+            self.log.warning('Related pages are stale: run rebuild_related()')
 
-        # update the tagxref table:
-        self.execute(u'DELETE FROM tagxref WHERE pageid=?', docid)
-        self._link_tags(docid, tags)
+        query = _col_select(columns,
+                u" FROM page, related" \
+                u" WHERE related.pageid = (SELECT id FROM page WHERE key = ?)"
+                u"   AND page.id = related.relatedid" \
+                u" ORDER BY related.score DESC, related.relatedid")
+
+        return self._return_columns(columns, query, key)
+
+    def _create_related_tables(self):
+        ''' create the related tables (if they're not there already) '''
+        self.execute(_RELATED_TABLE_SQL)
+        self.execute(_RELATED_INDEX_SQL)
+        self.execute(_RELATED_REVERSE_INDEX_SQL)
+        self.execute(_RELATED_CONF_SQL)
+
+    def _related_conf(self):
+        ''' (k, weighting, fulltext, stale) from the last build_related, or
+            None if it's never been run. (including on dbs from before it
+            existed.)  Only looked up once, then kept on the instance. '''
+        if self._related_settings is False:
+            self._related_settings = None
+            if self._has_table(u'relatedconf'):
+                self._related_settings = self.execute(
+                    u"SELECT k, weighting, fulltext, stale"
+                    u" FROM relatedconf").fetchone()
+        return self._related_settings
+
+    def _mark_related_stale(self):
+        ''' the related table is out of date, and needs rebuild_related. '''
+        conf = self._related_conf()
+        if conf and not conf[3]:
+            self.execute(u"UPDATE relatedconf SET stale = 1")
+            self._related_settings = tuple(conf[:3]) + (1,)
+
+    def _related_features(self, pageid, weighting, fulltext):
+        ''' list of (weight, set(pageids)) for each tag (and word, if
+            fulltext) that $pageid has, asked for from the db. '''
+        pages = self.execute(u"SELECT COUNT(*) FROM page").fetchone()[0]
+
+        pages_with = {}
+        for tagid, other in self.execute(
+                u"SELECT x2.tagid, x2.pageid FROM tagxref x1, tagxref x2"
+                u" WHERE x1.pageid = ? AND x2.tagid = x1.tagid",
+                pageid).fetchall():
+            pages_with.setdefault(tagid, set()).add(other)
+
+        features = [(_weight(weighting, pages, len(others)), others)
+                    for others in pages_with.values()]
+
+        if fulltext:
+            text = self.execute(u"SELECT fulltext FROM pagefts"
+                                u" WHERE docid = ?", pageid).fetchone()
+            for term in _terms(text[0] if text else None):
+                others = set(x[0] for x in self.execute(
+                    u"SELECT docid FROM pagefts WHERE fulltext MATCH ?",
+                    u'"' + term + u'"').fetchall())
+                if others:
+                    features.append(
+                        (fulltext * _weight(weighting, pages, len(others)),
+                         others))
+
+        return features
+
+    def _store_related(self, pageid, top):
+        ''' replace the related pages of $pageid with $top '''
+        self.execute(u"DELETE FROM related WHERE pageid = ?", pageid)
+        self.cur.executemany(
+            u"INSERT INTO related(pageid, relatedid, score) VALUES(?, ?, ?)",
+            ((pageid, other, score) for other, score in top))
+
+    def _refresh_related(self, pageids):
+        ''' work out the related pages of $pageids again (if build_related
+            has been run). '''
+        conf = self._related_conf()
+        if not conf:
+            return
+        k, weighting, fulltext = conf[:3]
+
+        for pageid in pageids:
+            self._store_related(pageid, _top(_related_scores(pageid,
+                self._related_features(pageid, weighting, fulltext)), k))
+
+    def _related_changed(self, pageid, tags_changed=True):
+        ''' $pageid is new, or has new tags or fulltext, so work out its
+            related pages again, and those of any pages it might now be (or
+            no longer be) in the top k of. '''
+        conf = self._related_conf()
+        if not conf:
+            return
+        k, weighting, fulltext = conf[:3]
+
+        if not tags_changed and not fulltext:
+            return
+
+        if weighting == u'idf':
+            # the weights depend on how many pages there are, and have each
+            # tag - so every page's scores change.  Too much to redo here.
+            self._mark_related_stale()
+            return
+
+        scores = _related_scores(pageid,
+            self._related_features(pageid, weighting, fulltext))
+        self._store_related(pageid, _top(scores, k))
+
+        # scores are symmetric, so other pages only need redoing if this one
+        # was in their top k, or now beats the worst of it:
+        stale = set(x[0] for x in self.execute(
+            u"SELECT pageid FROM related WHERE relatedid = ?",
+            pageid).fetchall())
+
+        # (compared the same way _top sorts them, so ties go to older pages)
+        others = [p for p, s in scores.items() if s > 0]
+        current = {}
+        for chunk in _chunks(others):
+            for other, relatedid, score in self.execute(
+                    u"SELECT pageid, relatedid, score FROM related"
+                    u" WHERE pageid IN (" + _qs(chunk) + u")", # ?, ?, ...
+                    *chunk).fetchall():
+                count, worst = current.get(other, (0, None))
+                current[other] = (count + 1, (score, -relatedid)
+                                  if worst is None
+                                  else min(worst, (score, -relatedid)))
+
+        for other in others:
+            count, worst = current.get(other, (0, None))
+            if count < k or (scores[other], -pageid) > worst:
+                stale.add(other)
+
+        stale.discard(pageid)
+        self._refresh_related(sorted(stale))
@@ -1,6 +1,7 @@
 import unittest
 from os.path import exists
 import os
+import random
 from pagestore import _col_select, PageStore
 from sqlite3 import connect, InterfaceError
 
@@ -106,7 +107,9 @@ class TestBasicPageStore(unittest.TestCase):
             self.assertEqual(c.get_by_tags(('tag1', 'tag2'), 'html'), ['<html>'])
             self.assertEqual(c.get_by_tags('tag1', 'html', 'tag2'), [])
 
-class TestMediumPageStore(unittest.TestCase):
+class FoodStore(object):
+    ''' mixin: sets up a db with the daft demo data in it for each test,
+        and deletes it afterwards. '''
     def setUp(self):
         assert not exists(_DB)
         with PageStore(_DB) as c:
@@ -120,6 +123,7 @@ class TestMediumPageStore(unittest.TestCase):
         assert exists(_DB)
         os.remove(_DB)
 
+class TestMediumPageStore(FoodStore, unittest.TestCase):
 
     def test_all_tags(self):
         with PageStore(_DB) as c:
@@ -258,6 +262,9 @@ class TestMediumPageStore(unittest.TestCase):
 
             # check that the page is gone.
             self.assertEqual(c.get_by_key('durian'), None)
+            self.assertEqual(c.search('durian', 'key'), [])
+            self.assertEqual(c.execute(u'SELECT COUNT(*) FROM pagefts')
+                              .fetchone()[0], 2)
 
             # check that other pages still exist...
             self.assertEqual(c.get_by_key('chocolate'), choc['json'])
@@ -335,3 +342,435 @@ class TestMediumPageStore(unittest.TestCase):
 
             # but new tags work:
             self.assertEqual(c.get_by_tag('lived'),['[1,2,3]'])
+
+    def test_update_many(self):
+        with PageStore(_DB) as c:
+            c.update_many([
+                # tags unchanged, fulltext changed:
+                ('mango', '<i>mangoes</i>', mango['json'],
+                 'mango shakes', mango['tags']),
+                # renamed, tags changed:
+                ('durian pie', durian['html'], durian['json'],
+                 durian['fulltext'], ['food', 'yuck', 'dessert'], 'durian'),
+                # doesn't exist yet, so gets stored:
+                ('banoffie', '<banoffie>', '["banana","toffie"]',
+                 'yum in a pie', ['food', 'dessert'])])
+
+            self.assertEqual(c.get_by_key('mango', 'html'), '<i>mangoes</i>')
+            self.assertEqual(c.search('smoothies', 'key'), [])
+            self.assertEqual(c.search('shakes', 'key'), ['mango'])
+            self.assertEqual(sorted(c.get_tags_of_page('mango')),
+                             sorted(mango['tags']))
+
+            self.assertEqual(c.get_by_key('durian'), None)
+            self.assertEqual(sorted(c.get_tags_of_page('durian pie')),
+                             ['dessert', 'food', 'yuck'])
+            self.assertEqual(c.search('durian', 'key'), ['durian pie'])
+
+            self.assertEqual(c.get_by_tag('fruit', 'key'), ['mango'])
+            self.assertEqual(sorted(c.get_by_tag('dessert', 'key')),
+                             ['banoffie', 'durian pie'])
+
+    def test_update_many_tags_not_relinked(self):
+        with PageStore(_DB) as c:
+            before = c.execute(u'SELECT rowid, tagid FROM tagxref'
+                               u' WHERE pageid = 1').fetchall()
+
+            c.update_many([('chocolate', choc['html'], choc['json'],
+                            choc['fulltext'], choc['tags'])])
+
+            # untouched xref rows keep their rowids:
+            self.assertEqual(c.execute(u'SELECT rowid, tagid FROM tagxref'
+                                       u' WHERE pageid = 1').fetchall(),
+                             before)
+
+class TestChangeFeed(FoodStore, unittest.TestCase):
+    def test_changes_since(self):
+        with PageStore(_DB) as c:
+            changes = list(c.changes_since())
+            self.assertEqual([x[:3] for x in changes],
+                             [(1, 'chocolate', False),
+                              (2, 'mango', False),
+                              (3, 'durian', False)])
+            self.assertEqual(changes[1][3:6],
+                (mango['html'], mango['json'], mango['fulltext']))
+            self.assertEqual(sorted(changes[1][6]), sorted(mango['tags']))
+
+            # only later changes:
+            self.assertEqual([x[1] for x in c.changes_since(2)], ['durian'])
+            self.assertEqual(list(c.changes_since(3)), [])
+
+    def test_changes_since_updates_and_purges(self):
+        with PageStore(_DB) as c:
+            c.update('mango', '<i>mangoes</i>', mango['json'],
+                     mango['fulltext'], mango['tags'])
+            c.update('durian pie', durian['html'], durian['json'],
+                     durian['fulltext'], durian['tags'], old_key='durian')
+            c.purge('chocolate')
+            # nothing there, so no tombstone:
+            c.purge('souvlakia')
+
+            self.assertEqual([x[:3] for x in c.changes_since(3)],
+                             [(4, 'mango', False),
+                              (5, 'durian', True),
+                              (6, 'durian pie', False),
+                              (7, 'chocolate', True)])
+
+            self.assertEqual(list(c.changes_since(6)),
+                [(7, 'chocolate', True, None, None, None, None)])
+
+    def test_changes_purge_everything(self):
+        with PageStore(_DB) as c:
+            c.purge(everything=True)
+
+            self.assertEqual([x[1:3] for x in c.changes_since(3)],
+                             [('chocolate', True),
+                              ('mango', True),
+                              ('durian', True)])
+
+    def test_apply_changes(self):
+        with PageStore(':memory:') as replica, PageStore(_DB) as c:
+            replica.initialise()
+
+            seq = replica.apply_changes(c.changes_since())
+            self.assertEqual(seq, 3)
+            self.assertEqual(sorted(replica.all_pages(['key', 'json'])),
+                             sorted(c.all_pages(['key', 'json'])))
+            self.assertEqual(replica.search('smoothies', 'key'), ['mango'])
+            self.assertEqual(replica.get_by_tag('healthy', 'key'),
+                             ['mango', 'durian'])
+
+            c.update('durian pie', durian['html'], durian['json'],
+                     'durian pie is quite something', ['dessert'],
+                     old_key='durian')
+            c.purge('chocolate')
+
+            seq = replica.apply_changes(c.changes_since(seq))
+            self.assertEqual(seq, 6)
+            self.assertEqual(sorted(replica.all_pages('key')),
+                             ['durian pie', 'mango'])
+            self.assertEqual(replica.search('something', 'key'),
+                             ['durian pie'])
+            self.assertEqual(replica.get_tags_of_page('durian pie'),
+                             ['dessert'])
+
+            # nothing new:
+            self.assertEqual(replica.apply_changes(c.changes_since(seq)),
+                             None)
+
+    def test_rename_onto_existing_key(self):
+        with PageStore(':memory:') as replica, PageStore(_DB) as c:
+            replica.initialise()
+            replica.apply_changes(c.changes_since())
+
+            # 'mango' is already there, so this does nothing:
+            c.update('mango', '<!-- -->', '[1,2,3]', 'stuff changed',
+                     ['we', 'all'], old_key='chocolate')
+
+            self.assertEqual(c.get_by_key('chocolate', 'html'), choc['html'])
+            self.assertEqual(c.get_by_key('mango', 'html'), mango['html'])
+            self.assertEqual(sorted(c.get_tags_of_page('chocolate')),
+                             sorted(choc['tags']))
+            self.assertEqual(c.search('stuff', 'key'), [])
+
+            # and so doesn't tell replicas to delete anything:
+            self.assertEqual(list(c.changes_since(3)), [])
+            self.assertEqual(replica.apply_changes(c.changes_since(3)), None)
+            self.assertEqual(sorted(replica.all_pages('key')),
+                             ['chocolate', 'durian', 'mango'])
+
+    def test_identical_update_not_logged(self):
+        with PageStore(_DB) as c:
+            last = list(c.changes_since())[-1][0]
+
+            # a rebuild, where nothing has actually changed:
+            c.update_many([(row['key'], row['html'], row['json'],
+                            row['fulltext'], row['tags']) for row in food])
+            self.assertEqual(list(c.changes_since(last)), [])
+
+            # but anything which has, is:
+            c.update_many([(row['key'], row['html'], row['json'],
+                            row['fulltext'], row['tags']) for row in food] +
+                          [('mango', mango['html'], '"changed"',
+                            mango['fulltext'], mango['tags'])])
+            self.assertEqual([x[1] for x in c.changes_since(last)],
+                             ['mango'])
+
+    def test_purge_everything_uninitialised(self):
+        with PageStore(':memory:') as c:
+            c.purge(everything=True)
+            self.assertEqual(c.all_pages(), [])
+            self.assertEqual(list(c.changes_since()), [])
+
+    def test_old_db_without_changes_table(self):
+        with PageStore(_DB) as c:
+            c.execute(u'DROP TABLE pagechange')
+
+        with PageStore(_DB) as c:
+            self.assertEqual(list(c.changes_since()), [])
+
+        with PageStore(_DB) as c:
+            c.purge(everything=True)
+
+            self.assertEqual([x[1:3] for x in c.changes_since()],
+                             [('chocolate', True),
+                              ('mango', True),
+                              ('durian', True)])
+
+class TestTagIndex(FoodStore, unittest.TestCase):
+    def assertSameAnswers(self, c, i, *args, **kwargs):
+        # the indexed store and the plain sql store should always agree:
+        self.assertEqual(sorted(i.get_by_tags(*args, **kwargs)),
+                         sorted(c.get_by_tags(*args, **kwargs)))
+        args = (args[0],) + args[2:]
+        self.assertEqual(i.count_by_tags(*args, **kwargs),
+                         c.count_by_tags(*args, **kwargs))
+
+    def test_get_by_tags(self):
+        with PageStore(_DB, tag_index=True) as c:
+            self.assertEqual(c.get_by_tags([]), [])
+            self.assertEqual(c.get_by_tags('unhealthy'), [choc['json']])
+            self.assertEqual(c.get_by_tags('fruit', 'key'),
+                             [mango['key'], durian['key']])
+            self.assertEqual(c.get_by_tags(['fruit', 'mouldy'], 'key'),
+                             [mango['key'], durian['key']])
+            self.assertEqual(c.get_by_tags('food', 'key', exclude='yuck'),
+                             [choc['key'], mango['key']])
+            self.assertEqual(c.get_by_tags((), 'key',
+                                           require=('yum', 'fruit')),
+                             [mango['key']])
+            self.assertEqual(c.get_by_tags('yuck', 'key',
+                                           require=('yum', 'fruit')), [])
+            self.assertEqual(c.get_by_tag('healthy', ('key', 'html')),
+                             [(mango['key'], mango['html']),
+                              (durian['key'], durian['html'])])
+
+            with self.assertRaises(TypeError):
+                c.get_by_tags(42)
+
+    def test_count_by_tags(self):
+        with PageStore(_DB, tag_index=True) as c:
+            self.assertEqual(c.count_by_tags('food'), 3)
+            self.assertEqual(c.count_by_tags('food', exclude='fruit'), 1)
+            self.assertEqual(c.count_by_tags('food', require='healthy'), 2)
+            self.assertEqual(c.count_by_tags('nothing'), 0)
+
+    def test_same_as_sql(self):
+        with PageStore(_DB) as c, PageStore(_DB, tag_index=True) as i:
+            for args, kwargs in (
+                    (('food', 'key'), {}),
+                    ((['yum', 'yuck'], 'key'), {'exclude': 'processed'}),
+                    (((), 'key'), {'require': ['food', 'healthy']}),
+                    (('yum', 'key'), {'require': 'fruit', 'exclude': 'yuck'}),
+                    (('yum', 'key'), {'require': ['fruit', 'fruit']}),
+                    (((), 'key'), {'require': 'plasticky'})):
+                self.assertSameAnswers(c, i, *args, **kwargs)
+
+    def test_kept_up_to_date(self):
+        with PageStore(_DB, tag_index=True) as c:
+            # load the index:
+            self.assertEqual(c.count_by_tags('food'), 3)
+
+            c.store('banoffie', '<banoffie>', '["banana","toffie"]',
+                    'yum in a pie', ['food', 'dessert'])
+            self.assertEqual(c.get_by_tags('dessert', 'key'), ['banoffie'])
+
+            c.update('durian pie', durian['html'], durian['json'],
+                     durian['fulltext'], ['food', 'dessert', 'yuck'],
+                     old_key='durian')
+            self.assertEqual(c.get_by_tags('dessert', 'key'),
+                             ['durian pie', 'banoffie'])
+            self.assertEqual(c.get_by_tags('fruit', 'key'), ['mango'])
+
+            c.purge('chocolate')
+            self.assertEqual(c.get_by_tags('yum', 'key'), ['mango'])
+            self.assertEqual(c.count_by_tags('food'), 3)
+
+            c.purge(everything=True)
+            self.assertEqual(c.count_by_tags('food'), 0)
+
+class TestRelated(FoodStore, unittest.TestCase):
+    def test_not_built(self):
+        with PageStore(_DB) as c:
+            self.assertEqual(c.get_related('mango'), [])
+
+    def test_build_related_idf(self):
+        with PageStore(_DB) as c:
+            c.build_related(k=2)
+
+            # 'food' is on everything, so is worth nothing:
+            self.assertEqual(c.get_related('chocolate', 'key'), ['mango'])
+            self.assertEqual(c.get_related('mango', 'key'),
+                             ['durian', 'chocolate'])
+            self.assertEqual(c.get_related('durian', ('key', 'html')),
+                             [('mango', mango['html'])])
+
+            self.assertEqual(c.get_related('souvlakia'), [])
+
+    def test_build_related_count(self):
+        with PageStore(_DB) as c:
+            c.build_related(k=2, weighting='count')
+
+            self.assertEqual(c.get_related('chocolate', 'key'),
+                             ['mango', 'durian'])
+            self.assertEqual(c.get_related('durian', 'key'),
+                             ['mango', 'chocolate'])
+
+            # only the top k:
+            c.build_related(k=1, weighting='count')
+            self.assertEqual(c.get_related('chocolate', 'key'), ['mango'])
+
+            with self.assertRaises(AssertionError):
+                c.build_related(weighting='random')
+
+    def test_build_related_fulltext(self):
+        with PageStore(_DB) as c:
+            c.store('apple', '', '', 'apples and pears', [])
+            c.store('plum', '', '', 'pears and plums', [])
+
+            c.build_related()
+            self.assertEqual(c.get_related('apple', 'key'), [])
+
+            c.build_related(fulltext=1.0)
+            self.assertEqual(c.get_related('apple', 'key'), ['plum'])
+
+    def test_kept_up_to_date(self):
+        with PageStore(_DB) as c:
+            c.build_related(k=2, weighting='count')
+
+            c.store('banoffie', '<banoffie>', '["banana","toffie"]',
+                    'yum in a pie', ['yum', 'dessert'])
+            # (ties go to the older page)
+            self.assertEqual(c.get_related('banoffie', 'key'),
+                             ['chocolate', 'mango'])
+            self.assertEqual(c.get_related('chocolate', 'key'),
+                             ['mango', 'durian'])
+
+            c.update('chocolate', choc['html'], choc['json'],
+                     choc['fulltext'], ['dessert'])
+            self.assertEqual(c.get_related('chocolate', 'key'), ['banoffie'])
+            self.assertEqual(c.get_related('banoffie', 'key'),
+                             ['chocolate', 'mango'])
+
+            c.purge('mango')
+            self.assertEqual(c.get_related('durian', 'key'), [])
+            self.assertEqual(c.get_related('banoffie', 'key'), ['chocolate'])
+
+            c.purge(everything=True)
+            self.assertEqual(c.get_related('banoffie', 'key'), [])
+
+    def test_idf_goes_stale(self):
+        with PageStore(_DB) as c:
+            c.build_related(k=2)
+            self.assertFalse(c.related_stale())
+
+            # only the fulltext changed, which doesn't count here:
+            c.update('mango', mango['html'], mango['json'], 'mango lassi',
+                     mango['tags'])
+            self.assertFalse(c.related_stale())
+
+            c.store('banoffie', '<banoffie>', '["banana","toffie"]',
+                    'yum in a pie', ['yum', 'dessert'])
+            self.assertTrue(c.related_stale())
+
+            # still there, but not worked out for banoffie yet:
+            self.assertEqual(c.get_related('chocolate', 'key'), ['mango'])
+            self.assertEqual(c.get_related('banoffie', 'key'), [])
+
+        with PageStore(_DB) as c:
+            # (stale is kept in the db)
+            self.assertTrue(c.related_stale())
+
+            c.rebuild_related()
+            self.assertFalse(c.related_stale())
+            self.assertEqual(c.get_related('banoffie', 'key'),
+                             ['chocolate', 'mango'])
+
+    def test_incremental_same_as_rebuild(self):
+        # lots of small pools, so lots of ties:
+        tags = ['a', 'b', 'c', 'd', 'e']
+        words = ['foo_bar', 'foo', 'bar', 'Baz', 'baz']
+
+        for seed, weighting in [(s, w) for s in range(20)
+                                       for w in ('count', 'idf')]:
+            rand = random.Random(seed)
+
+            def page():
+                return ('', '',
+                        ' '.join(rand.sample(words, rand.randint(0, 3))),
+                        rand.sample(tags, rand.randint(0, 3)))
+
+            with PageStore(':memory:') as c:
+                c.initialise()
+                for i in range(8):
+                    c.store('p%d' % i, *page())
+                c.build_related(k=3, weighting=weighting, fulltext=1.0)
+
+                for i in range(8, 33):
+                    keys = c.all_pages('key')
+                    todo = rand.choice(('store', 'update', 'purge'))
+                    if todo == 'store' or not keys:
+                        c.store('p%d' % i, *page())
+                    elif todo == 'update':
+                        c.update(rand.choice(keys), *page())
+                    else:
+                        c.purge(rand.choice(keys))
+
+                keys = c.all_pages('key')
+                incremental = [c.get_related(key, 'key') for key in keys]
+
+                # idf can't be kept up to date, so says so instead:
+                self.assertEqual(c.related_stale(), weighting == 'idf')
+                c.rebuild_related()
+                self.assertFalse(c.related_stale())
+                if weighting == 'idf':
+                    incremental = [c.get_related(key, 'key') for key in keys]
+
+                c.build_related(k=3, weighting=weighting, fulltext=1.0)
+                self.assertEqual(incremental,
+                                 [c.get_related(key, 'key') for key in keys])
+
+    def test_fulltext_words_split_like_fts(self):
+        with PageStore(_DB) as c:
+            c.store('spaced', '', '', 'foo bar', [])
+            c.store('joined', '', '', 'nothing', [])
+            c.build_related(weighting='count', fulltext=1.0)
+
+            # '_' splits words in the fts, so these do share words:
+            c.update('joined', '', '', 'foo_bar', [])
+            self.assertEqual(c.get_related('joined', 'key'), ['spaced'])
+
+            # but the fts only lowercases ascii, so these don't:
+            c.update('spaced', '', '', u'\xc4rger', [])
+            c.update('joined', '', '', u'\xe4rger', [])
+            self.assertEqual(c.get_related('joined', 'key'), [])
+
+            c.build_related(weighting='count', fulltext=1.0)
+            self.assertEqual(c.get_related('joined', 'key'), [])
+
+            # and everything non-ascii is part of a word, even > U+FFFF:
+            c.update('spaced', '', '', u'foo\U0001F600bar', [])
+            c.update('joined', '', '', u'foo\U0001F600bar', [])
+            self.assertEqual(c.get_related('joined', 'key'), ['spaced'])
+
+            c.build_related(weighting='count', fulltext=1.0)
+            self.assertEqual(c.get_related('joined', 'key'), ['spaced'])
+
+    def test_old_db_without_related_tables(self):
+        with PageStore(_DB) as c:
+            c.execute(u'DROP TABLE related')
+            c.execute(u'DROP TABLE relatedconf')
+
+        with PageStore(_DB) as c:
+            self.assertEqual(c.get_related('mango'), [])
+            self.assertFalse(c.related_stale())
+
+            c.store('banoffie', '<banoffie>', '["banana","toffie"]',
+                    'yum in a pie', ['yum', 'dessert'])
+            c.update('banoffie', '<banoffie>', '["banana","toffie"]',
+                     'yum in a pie', ['yum'])
+            c.purge('durian')
+
+            c.build_related(k=2, weighting='count')
+            self.assertEqual(c.get_related('banoffie', 'key'),
+                             ['chocolate', 'mango'])